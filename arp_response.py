@@ -1,7 +1,10 @@
 from pox.core import core
 from pox.lib.revent import *
 import pox.openflow.libopenflow_01 as of
-from scapy.all import *
+from pox.lib.addresses import EthAddr
+from pox.lib.packet.ethernet import ethernet
+from pox.lib.packet.arp import arp
+import struct
 
 """
 We want to ARP response all ARP requests with our own IP/mac.  The idea is to
@@ -32,39 +35,35 @@ class ArpResponse( EventMixin ):
         # the controller???
 
     def _handle_PacketIn(self, event):
-        pkt = Ether(event.data)
+        # switch belongs to another shard, it answers
+        if not core.discovery.owns(event.dpid):
+            return
         # if not an ARP packet then nothing to see, move along...
-        if not pkt[Ether].type == 0x0806:
+        if not struct.unpack('!H', event.data[12:14])[0] == 0x0806:
             return
         # type is ARP, but do we really have an ARP packet?
-        if not ARP in pkt:
+        pkt = event.parsed.find('arp')
+        if not pkt:
             log.error('ARP_RESPONSE: Received bad ARP Packet')
             return
         # is it an ARP request?
-        if pkt[ARP].op == 1:
+        if pkt.opcode == arp.REQUEST:
             # XXX Have to check if the src hwaddr and paddr are already in the
             # gmat, if not, then add it?
-            is_at = [x['mac'] for x in core.discovery.gmat if  x['ip'] == pkt[ARP].pdst].pop()
-            src = is_at
-            dst = pkt[Ether].src
-            type = pkt[Ether].type
+            is_at = [x['mac'] for x in core.discovery.gmat if  x['ip'] == str(pkt.protodst)].pop()
             # we are proxy'ing for the pdst
-            hwsrc = is_at
-            psrc = pkt[ARP].pdst
-            hwdst = pkt[ARP].hwsrc
-            pdst =pkt[ARP].psrc
-            # arp-reply
-            op = 2
-            arp_reply = Ether(src=src, dst=dst, type=type)/\
-                        ARP(hwsrc=hwsrc, psrc=psrc, hwdst=hwdst, pdst=pdst, op=op)
+            arp_reply = arp(opcode = arp.REPLY, hwsrc = EthAddr(is_at), protosrc = pkt.protodst, \
+                            hwdst = pkt.hwsrc, protodst = pkt.protosrc)
+            eth = ethernet(src = EthAddr(is_at), dst = event.parsed.src, type = ethernet.ARP_TYPE)
+            eth.payload = arp_reply
             # create openflow message
-            log.debug('ARP_RESPONSE: Got ARP who-has for %s. Sent %s is-at %s' % (pkt[ARP].pdst, pkt[ARP].pdst, is_at))
+            log.debug('ARP_RESPONSE: Got ARP who-has for %s. Sent %s is-at %s' % (pkt.protodst, pkt.protodst, is_at))
             msg = of.ofp_packet_out()
             # send the arp reply from the same port the request was received
             msg.actions.append(of.ofp_action_output(port = event.port))
-            msg.data = bytes(arp_reply)
+            msg.data = eth.pack()
             event.connection.send(msg)
-        if pkt[ARP].op == 2:
+        if pkt.opcode == arp.REPLY:
             # XXX got arp-response packet, refresh gmat?
             log.debug('ARP_RESPONSE: got ARP Reply packet')
 
@@ -0,0 +1,78 @@
+"""
+Startup time and memory benchmark for the launch() of the POX components.
+
+Every component is launched in a fresh python process (with the components
+it depends on launched first) so module imports are measured too. Reports
+the wall time of the imports + launch() and the max RSS of the process.
+
+Usage:
+
+$ python bench_launch.py --pox /home/user/pox [--max-time 1 --max-rss 100]
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+# components and the components they need loaded before
+COMPONENTS = [('discovery', []),
+              ('arp_response', ['discovery']),
+              ('routing', ['discovery', 'arp_response'])]
+
+# run in the child process: %(pox)s, %(here)s and %(modules)s filled below
+CHILD = """
+import os, sys, time, resource
+sys.path[:0] = [%(pox)r, %(here)r]
+from pox.core import core
+import pox.openflow
+pox.openflow.launch()
+start = time.time()
+for name in %(modules)r:
+    __import__(name).launch()
+elapsed = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+sys.stdout.write('%%f %%d' %% (elapsed, rss))
+sys.stdout.flush()
+# POX threads would keep us alive
+os._exit(0)
+"""
+
+
+def bench(pox, component, deps):
+    code = CHILD % dict(pox = pox, here = os.path.dirname(os.path.abspath(__file__)), \
+                        modules = deps + [component])
+    out = subprocess.check_output([sys.executable, '-c', code])
+    elapsed, rss = out.split()[-2:]
+    return float(elapsed), int(rss)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pox', dest = 'pox', required = True, \
+                         help = 'POX directory.')
+    parser.add_argument('-n', dest = 'runs', type = int, default = 5, \
+                         help = 'Runs per component. Defaults to 5.')
+    parser.add_argument('--max-time', dest = 'max_time', type = float, \
+                         help = 'Fail if a component takes longer (s) to launch.')
+    parser.add_argument('--max-rss', dest = 'max_rss', type = float, \
+                         help = 'Fail if a component takes more memory (MB).')
+    args = parser.parse_args()
+
+    failed = False
+
+    print "%-15s %12s %12s" % ('component', 'launch (s)', 'max rss (MB)')
+    for component, deps in COMPONENTS:
+        results = [bench(args.pox, component, deps) for i in range(args.runs)]
+        # best of n, less noise from the rest of the box
+        elapsed = min([e for e, r in results])
+        rss = min([r for e, r in results])
+        print "%-15s %12.3f %12.1f" % (component, elapsed, rss / 1024.0)
+        if (args.max_time and elapsed > args.max_time) or \
+           (args.max_rss and rss / 1024.0 > args.max_rss):
+            print "%s is over budget" % component
+            failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
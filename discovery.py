@@ -29,19 +29,62 @@ from pox.lib.revent import *
 from pox.lib.recoco import Timer
 import pox.openflow.libopenflow_01 as of
 import networkx as nx
-import matplotlib.pyplot as plt
+import math
+import os
+import random
+import struct
 import time
-import threading
 from util import *
-from scapy.all import *
+from shard import ShardChannel, parse_address
+# LLDPs are built/parsed by hand, ARPs come parsed by POX
+from pox.lib.packet.arp import arp
 
 log = core.getLogger()
 
+# weight of a new sample in the smoothed rtt/latency estimations
+LATENCY_ALPHA = 0.125
+# how often (seconds) the controller-to-switch rtt is measured
+RTT_PROBE_INTERVAL = 5
+# max interval (seconds) between LLDPs on host facing ports
+LLDP_MAX_BACKOFF = 32
+# how often (seconds) shards send each other their full view
+SHARD_SYNC_INTERVAL = 5
+# pieces written per POX loop iteration when exporting the topology
+EXPORT_CHUNK_SIZE = 500
+# export formats and the functions writing them
+EXPORT_FORMATS = {'json': topology_json, 'graphml': topology_graphml}
+
+class ConnectivityChanged( Event ):
+    """
+    Raised when the topology gets partitioned or partitions get joined
+    """
+
+    def __init__(self, components):
+        Event.__init__(self)
+        # number of connected components after the change
+        self.components = components
+
+
+class HostAdded( Event ):
+    """
+    Raised when a new host shows up in the global mac-address-table
+    """
+
+    def __init__(self, host):
+        Event.__init__(self)
+        # the new gmat entry (dpid, port, mac, ip)
+        self.host = host
+
+
 class Discovery( EventMixin ):
 
-    def __init__(self):
+    _eventMixin_events = set([ConnectivityChanged, HostAdded])
+
+    def __init__(self, shard = 0, shards = 1, listen = None, peers = []):
         # networkx representation of the topology
         self.topo = nx.Graph()
+        # connected components index of topo
+        self.connectivity = Connectivity(self.topo)
         # global mac-address-table (dpid, port, mac, ip)
         self.gmat = []
 
@@ -55,10 +98,32 @@ class Discovery( EventMixin ):
                      dict(ip='10.0.0.5',mac='00:00:00:00:00:05',dpid=5,port=1),
                      dict(ip='10.0.0.6',mac='00:00:00:00:00:06',dpid=6,port=1),
                      dict(ip='10.0.0.7',mac='00:00:00:00:00:07',dpid=7,port=1)]
+        # node positions of the last graph() ({node: (x, y)}) and the kind
+        # of layout they come from (tree or not)
+        self.layout = {}
+        self.layout_tree = None
         # list of switches already scheduled w/sendLLDP
         self.scheduled_switches = []
         # send lldp every ldp ttl seconds
         self.lldp_ttl = 1
+        # smoothed controller-to-switch rtt (dpid -> seconds)
+        self.switch_rtt = {}
+        # outstanding rtt probes ((dpid, xid) -> send time)
+        self.rtt_probes = {}
+        # ports that have received LLDPs, i.e. inter-switch ports
+        self.lldp_ports = set()
+        # ports with hosts behind them (dpid, port)
+        self.host_ports = set([(h['dpid'], h['port']) for h in self.gmat])
+        # LLDP backoff of host facing ports ((dpid, port) -> {interval, next})
+        self.lldp_backoff = {}
+        # this process only runs discovery for dpids where
+        # dpid % shards == shard, the rest comes from the other shards
+        self.shard = shard
+        self.shards = shards
+        self.channel = None
+        if shards > 1:
+            self.channel = ShardChannel(shard, listen, peers, self.apply_delta)
+            Timer(SHARD_SYNC_INTERVAL, self.sync_shards, recurring = True)
         # listen to all pox/openflow events
         core.openflow.addListeners(self)
 
@@ -68,8 +133,16 @@ class Discovery( EventMixin ):
         Timer(self.lldp_ttl * 3, self.link_collector, recurring = True)
         log.info('Discovery link collector started')
 
+        # link latency is measured from LLDPs but the controller-to-switch
+        # part of the trip has to be subtracted
+        Timer(RTT_PROBE_INTERVAL, self.probe_rtt, recurring = True)
+
 
     def _handle_ConnectionUp(self, event):
+        # switch belongs to another shard
+        if not self.owns(event.dpid):
+            log.debug('DISCOVERY: Switch %s belongs to another shard' % event.dpid)
+            return
 
         # XXX while debugging del all flows from switches
         msg = of.ofp_flow_mod(command = of.OFPFC_DELETE)
@@ -104,7 +177,16 @@ class Discovery( EventMixin ):
 
     
     def _handle_ConnectionDown(self, event):
-        n1 = event.dpid
+        if not self.owns(event.dpid):
+            return
+        self.remove_switch(event.dpid)
+        self.publish('switch_down', dpid = event.dpid)
+
+
+    def remove_switch(self, n1):
+        """
+        Removes switch n1 and its links from the topology
+        """
         if n1 in self.topo.nodes():
             log.info("Switch %s is DOWN" % n1)
             neighboring_nodes = [n for i, (p, n) in enumerate(self.topo.node[n1]['link_to'])]
@@ -112,11 +194,28 @@ class Discovery( EventMixin ):
                 delete_edge(self.topo, n1, n)
             # remove node from topological view
             self.topo.remove_node(n1)
+            if self.connectivity.remove_node(n1):
+                self.connectivity_changed()
             # remove switch from LLDP send scheduled dpids
-            self.scheduled_switches.remove(n1)
+            if n1 in self.scheduled_switches:
+                self.scheduled_switches.remove(n1)
+        if n1 in self.switch_rtt:
+            del self.switch_rtt[n1]
+        for key in [k for k in self.lldp_ports if k[0] == n1]:
+            self.lldp_ports.discard(key)
+        for key in [k for k in self.lldp_backoff.keys() if k[0] == n1]:
+            del self.lldp_backoff[key]
 
 
     def _handle_PortStatus(self, event):
+        if not self.owns(event.dpid):
+            return
+        # whatever changed, port goes back to full rate LLDP probing
+        key = (event.dpid, event.port)
+        self.lldp_ports.discard(key)
+        if key in self.lldp_backoff:
+            del self.lldp_backoff[key]
+
         # is port config down or port link down?
         if event.ofp.desc.config == 1 or event.ofp.desc.config == 1:
             # convenience variables
@@ -128,22 +227,60 @@ class Discovery( EventMixin ):
             # if edge does not exists, n2 is going to be to None
             if n1 and n2:
                 delete_edge(self.topo, n1, n2)
+                if self.connectivity.remove_edge(n1, n2):
+                    self.connectivity_changed()
+                self.publish('link_down', 'links', [[n1, n2]])
                 log.info('PORT STATUS: Link between switch %s and %s is down. Link removed from topo' % (n1, n2))
         # XXX code to handle when port comes up?
 
 
     def _handle_PacketIn(self, event):
         """rocess incoming packets."""
-        # scapy-fy packet
-        pkt = Ether(event.data)
+        if not self.owns(event.dpid):
+            return
+        # ethertype straight from the frame, LLDPs are parsed by hand
+        (type,) = struct.unpack('!H', event.data[12:14])
 
         # if pkt is LLDP then use it to manage topology view 
-        if pkt.type == 0x88cc: 
-            self.manage_topology(pkt, event.dpid, event.port)
+        if type == 0x88cc: 
+            self.manage_topology(parse_lldp(event.data), event.dpid, event.port)
 
         # if arp discover host
-        if pkt.type == 0x0806:
-            self.manage_hosts(pkt, event.dpid, event.port)
+        if type == 0x0806:
+            self.manage_hosts(event.parsed.find('arp'), event.dpid, event.port)
+
+
+    def _handle_BarrierIn(self, event):
+        # is it the reply to one of our rtt probes?
+        sent = self.rtt_probes.pop((event.dpid, event.xid), None)
+        if sent is None:
+            return
+        rtt = time.time() - sent
+        if event.dpid in self.switch_rtt:
+            rtt = (1 - LATENCY_ALPHA) * self.switch_rtt[event.dpid] + LATENCY_ALPHA * rtt
+        self.switch_rtt[event.dpid] = rtt
+
+
+    def probe_rtt(self):
+        """
+        Measures the controller-to-switch rtt of every switch with a barrier
+        request/reply round trip
+        """
+        now = time.time()
+        # forget about probes that never got an answer
+        for key, sent in self.rtt_probes.items():
+            if sent < now - RTT_PROBE_INTERVAL:
+                del self.rtt_probes[key]
+        for conn in core.openflow.connections:
+            msg = of.ofp_barrier_request()
+            self.rtt_probes[(conn.dpid, msg.xid)] = time.time()
+            conn.send(msg)
+
+
+    def connectivity_changed(self):
+        components = len(self.connectivity.members)
+        log.info('Topology has now %s connected component(s)' % components)
+        self.raiseEvent(ConnectivityChanged(components))
 
 
     def link_collector(self):
@@ -152,25 +289,35 @@ class Discovery( EventMixin ):
         """
         now = time.time()
         for n1, n2, d in self.topo.edges(data = True):
-            # if link older than 3*lldp_ttl, then remove it
-            if d['timestamp'] < (now - 3 * self.lldp_ttl):
+            # links between other shards' switches are refreshed by syncs
+            local = self.owns(n1) or self.owns(n2)
+            if local:
+                ttl = 3 * self.lldp_ttl
+            else:
+                ttl = 3 * SHARD_SYNC_INTERVAL
+            # if link older than ttl, then remove it
+            if d['timestamp'] < (now - ttl):
                 # from both nodes remove port info
                 delete_edge(self.topo, n1, n2)
+                if self.connectivity.remove_edge(n1, n2):
+                    self.connectivity_changed()
+                if local:
+                    self.publish('link_down', 'links', [[n1, n2]])
 
 
-    def manage_topology(self, pkt, l_dpid, l_port):
+    def manage_topology(self, lldp, l_dpid, l_port):
         """
-        Creates/Updates the topology acording to what it "hears" from LLDP
+        Creates/Updates the topology acording to what it "hears" from LLDP.
+        'lldp' is the LLDP as returned by parse_lldp
         """
         # is it a well formed LLDP packet?
-        if pkt.type == 0x88cc and \
-            LLDPChassisId in pkt and \
-            LLDPPortId in pkt and \
-            LLDPTTL in pkt and \
-            LLDPDUEnd in pkt:
+        if lldp:
                # comodity/documentation variables
-               r_dpid = int(pkt['LLDPChassisId'].value)
-               r_port = int(pkt['LLDPPortId'].value)
+               r_dpid = lldp['chassis_id']
+               r_port = lldp['port']
+               sent = lldp['timestamp']
+               # l_port is an inter-switch port, keep probing it at full rate
+               self.lldp_ports.add((l_dpid, l_port))
                #log.debug('Got LLDP packet [Switch: %s Port %s] from switch %s port %s' \
 
                # 1) if "seen" nodes are new, add them to the topology view
@@ -181,24 +328,167 @@ class Discovery( EventMixin ):
                # 2) is edge new? is so, add it and timestampt it
                if not ((l_dpid, r_dpid) in self.topo.edges() or (r_dpid,l_dpid) in self.topo.edges()):
                    self.topo.add_edge(l_dpid, r_dpid, {'timestamp':time.time()})
+                   if self.connectivity.add_edge(l_dpid, r_dpid):
+                       self.connectivity_changed()
                # it not new, refresh timestamp
                else:
                    self.topo.edge[l_dpid][r_dpid]['timestamp'] = time.time()
                # 3) keep track of ports usage in l_dpid...l_port in l_dpid links to r_dpid 
-               if l_dpid in self.topo.nodes():
-                   if (l_port, r_dpid) not in self.topo.node[l_dpid]['link_to']:
-                       self.topo.node[l_dpid]['link_to'].append((l_port,r_dpid))
+               # and r_port in r_dpid links to l_dpid (r_dpid may belong to
+               # another shard and never tell us)
+               new_link = False
+               if (l_port, r_dpid) not in self.topo.node[l_dpid]['link_to']:
+                   self.topo.node[l_dpid]['link_to'].append((l_port,r_dpid))
+                   new_link = True
+               if (r_port, l_dpid) not in self.topo.node[r_dpid]['link_to']:
+                   self.topo.node[r_dpid]['link_to'].append((r_port,l_dpid))
+                   new_link = True
+               if new_link:
+                   self.publish('links', 'links', [[l_dpid, l_port, r_dpid, r_port]])
+               # 4) LLDP carries its send time, update link latency
+               if sent is not None:
+                   self.update_latency(l_dpid, r_dpid, sent)
+
+
+    def update_latency(self, l_dpid, r_dpid, sent):
+        """
+        Updates the smoothed latency of the link between l_dpid and r_dpid
+        from an LLDP sent by the controller at time 'sent'. Half of each
+        switch's rtt to the controller is subtracted from the trip
+        """
+        trip = time.time() - sent
+        delay = trip - (self.switch_rtt.get(l_dpid, 0) + self.switch_rtt.get(r_dpid, 0)) / 2
+        delay = max(delay, 0)
+        edge = self.topo.edge[l_dpid][r_dpid]
+        if 'latency' in edge:
+            delay = (1 - LATENCY_ALPHA) * edge['latency'] + LATENCY_ALPHA * delay
+        edge['latency'] = delay
+
+
+    def get_link_latencies(self):
+        """
+        Returns a dict (n1, n2) -> smoothed one-way latency (seconds) of all
+        the measured links
+        """
+        return dict([((n1, n2), d['latency']) for n1, n2, d in self.topo.edges(data = True) \
+                     if 'latency' in d])
 
 
     def manage_hosts(self, pkt, dpid, port):
         """
-        Manages the global mac-address-table
+        Manages the global mac-address-table. pkt is the arp packet as
+        parsed by POX
         """
         # XXX one mac/ip per port?
-        if pkt.type == 0x0806 and ARP in pkt and pkt[ARP].op in [1,2]:
-            if not(dict(dpid = dpid, port = port, mac = pkt.hwsrc, ip = pkt.psrc) in self.gmat):
-                self.gmat.append(dict(dpid = dpid, port = port, mac = pkt.hwsrc, ip = pkt.psrc))
-                log.debug('New host: %s at %s' % (pkt.psrc, pkt.hwsrc))
+        if pkt and pkt.opcode in [arp.REQUEST, arp.REPLY]:
+            host = dict(dpid = dpid, port = port, mac = str(pkt.hwsrc), ip = str(pkt.protosrc))
+            if not(host in self.gmat):
+                self.add_host(host)
+                self.publish('hosts', 'hosts', [host])
+                log.debug('New host: %s at %s' % (pkt.protosrc, pkt.hwsrc))
+
+
+    def add_host(self, host):
+        """
+        Adds host to the global mac-address-table and tells everyone
+        """
+        self.gmat.append(host)
+        self.host_ports.add((host['dpid'], host['port']))
+        self.raiseEvent(HostAdded(host))
+
+
+    def owns(self, dpid):
+        """
+        True if dpid is managed by this shard
+        """
+        return dpid % self.shards == self.shard
+
+
+    def publish(self, type, key = None, items = None, **kw):
+        """
+        Tells the other shards about a topology change, if sharded
+        """
+        if self.channel:
+            self.channel.publish(type, key, items, **kw)
+
+
+    def sync_shards(self):
+        """
+        Sends the other shards every link touching our switches and every
+        host behind them. Keeps their view fresh and brings up to date
+        shards that (re)started
+        """
+        links = []
+        for n1, n2 in self.topo.edges():
+            if not (self.owns(n1) or self.owns(n2)):
+                continue
+            (p1, p2) = get_linking_ports(self.topo, n1, n2)
+            if p1 and p2:
+                links.append([n1, p1, n2, p2])
+        self.publish('links', 'links', links)
+        self.publish('hosts', 'hosts', [h for h in self.gmat if self.owns(h['dpid'])])
+
+
+    def apply_delta(self, msg):
+        """
+        Merges into our view a topology change sent by another shard
+        """
+        if msg.get('shard') == self.shard:
+            return
+        if msg['type'] == 'links':
+            for n1, p1, n2, p2 in msg['links']:
+                self.add_link(n1, p1, n2, p2)
+        elif msg['type'] == 'link_down':
+            for n1, n2 in msg['links']:
+                if self.topo.has_edge(n1, n2):
+                    delete_edge(self.topo, n1, n2)
+                    if self.connectivity.remove_edge(n1, n2):
+                        self.connectivity_changed()
+        elif msg['type'] == 'hosts':
+            for h in msg['hosts']:
+                host = dict(dpid = h['dpid'], port = h['port'], mac = str(h['mac']), ip = str(h['ip']))
+                if not(host in self.gmat):
+                    self.add_host(host)
+        elif msg['type'] == 'switch_down':
+            self.remove_switch(msg['dpid'])
+
+
+    def add_link(self, n1, p1, n2, p2):
+        """
+        Adds/refreshes the link between port p1 of n1 and port p2 of n2
+        """
+        for n in (n1, n2):
+            if not n in self.topo.nodes():
+                self.topo.add_node(n, {'link_to':[]})
+        if not self.topo.has_edge(n1, n2):
+            self.topo.add_edge(n1, n2, {'timestamp':time.time()})
+            if self.connectivity.add_edge(n1, n2):
+                self.connectivity_changed()
+        else:
+            self.topo.edge[n1][n2]['timestamp'] = time.time()
+        if (p1, n2) not in self.topo.node[n1]['link_to']:
+            self.topo.node[n1]['link_to'].append((p1, n2))
+        if (p2, n1) not in self.topo.node[n2]['link_to']:
+            self.topo.node[n2]['link_to'].append((p2, n1))
+
+    def should_probe(self, dpid, port):
+        """
+        Decides if an LLDP has to be sent through dpid's port now. Ports
+        that never received an LLDP but have hosts behind them are probed
+        with exponential backoff, all the others at full rate
+        """
+        key = (dpid, port)
+        if key in self.lldp_ports or not key in self.host_ports:
+            return True
+        now = time.time()
+        state = self.lldp_backoff.setdefault(key, dict(interval = self.lldp_ttl, next = now))
+        # half a ttl of slack for the timer jitter
+        if now + self.lldp_ttl / 2.0 < state['next']:
+            return False
+        state['next'] = now + state['interval']
+        state['interval'] = min(state['interval'] * 2, LLDP_MAX_BACKOFF)
+        return True
+
 
     def send_LLDP(self, event):
         """
@@ -208,38 +498,69 @@ class Discovery( EventMixin ):
         """
         # note-to-self: event.ofp is of ofp_features_reply type
         # note-to-self: event.ofp.ports has all the port inventory in this dpid
-        # LLDP destination address
-        dst = '01:80:c2:00:00:0e'
-        # LLDP ethertype
-        type = 0x88cc
         # note-to-self: ofp.ports == port inventory for dpid
         for p in event.ofp.ports:
-            if p.port_no < of.OFPP_MAX:
+            if p.port_no < of.OFPP_MAX and self.should_probe(event.dpid, p.port_no):
                 chassis_id = event.dpid
-                src = str(p.hw_addr)
+                src = p.hw_addr.toRaw()
                 port = p.port_no
-                lldp_p = Ether(src = src, dst = dst, type = type)/\
-                        LLDPChassisId(subtype = 7, macaddr = '00:00:ca:fe:ba:be', value = chassis_id)/\
-                        LLDPPortId(subtype = 7, macaddr = src, value = port)/\
-                        LLDPTTL(seconds = self.lldp_ttl)/\
-                        LLDPDUEnd()
+                lldp_p = lldp_frame(src, chassis_id, port, self.lldp_ttl, time.time())
                 # send LLDP packet
                 pkt = of.ofp_packet_out(action = of.ofp_action_output(port = port))
-                pkt.data = bytes(lldp_p)
+                pkt.data = lldp_p
                 event.connection.send(pkt)
 
 
-    def graph(self, tree=False):
+    def update_layout(self, tree):
         """
-        Draws the current view of the topology. No hosts, just switches
+        Returns the node positions for graph(). Positions are cached between
+        calls, only nodes new since the last call get placed, next to their
+        already placed neighbours. Returns also the label offset
         """
-        plt.ion()
         if tree:
-            pos = nx.graphviz_layout(self.topo, prog='dot')
             offset = 10
         else:
-            pos = nx.circular_layout(self.topo)
             offset = 0.05
+        # first time or different kind of layout, lay out everything
+        if self.layout_tree != tree or not self.layout:
+            if tree:
+                self.layout = nx.graphviz_layout(self.topo, prog='dot')
+            else:
+                self.layout = nx.circular_layout(self.topo)
+            self.layout_tree = tree
+            return self.layout, offset
+        # forget about nodes gone...
+        for n in self.layout.keys():
+            if not n in self.topo:
+                del self.layout[n]
+        # ...and place the new ones
+        for n in self.topo.nodes():
+            if n in self.layout:
+                continue
+            placed = [self.layout[m] for m in self.topo.neighbors(n) if m in self.layout]
+            if placed:
+                x = sum([p[0] for p in placed]) / len(placed)
+                y = sum([p[1] for p in placed]) / len(placed)
+            elif self.layout:
+                (x, y) = random.choice(self.layout.values())
+            else:
+                (x, y) = (0, 0)
+            angle = random.uniform(0, 2 * math.pi)
+            self.layout[n] = (x + 4 * offset * math.cos(angle), y + 4 * offset * math.sin(angle))
+        return self.layout, offset
+
+
+    def graph(self, tree=False):
+        """
+        Draws the current view of the topology. No hosts, just switches
+        """
+        # matplotlib is slow to import and only needed here
+        import matplotlib.pyplot as plt
+        plt.ion()
+        pos, offset = self.update_layout(tree)
+        # redraw on the same figure instead of piling up drawings
+        plt.figure('topology')
+        plt.clf()
         nx.draw(self.topo, pos)
         node_labels = dict([(n,d['link_to']) for n,d in self.topo.nodes(data=True)])
 
@@ -253,6 +574,51 @@ class Discovery( EventMixin ):
         nx.draw_networkx_labels(self.topo, pos=pos_labels, labels=node_labels, font_size=8)
         plt.show()
 
-def launch():
-    core.register('discovery', Discovery())
+
+    def export(self, path, format='json'):
+        """
+        Writes the topology and the host table to path as json or graphml.
+        The file is written a chunk at a time from the POX loop so big
+        topologies do not block the controller. path shows up once complete
+        """
+        if not format in EXPORT_FORMATS:
+            raise ValueError('Unknown export format %r, use one of %s' % (format, ', '.join(sorted(EXPORT_FORMATS))))
+        # snapshot, the topology may change while we write
+        nodes = [(n, list(d['link_to'])) for n, d in self.topo.nodes(data=True)]
+        edges = [(n1, n2, dict(d)) for n1, n2, d in self.topo.edges(data=True)]
+        hosts = [dict(h) for h in self.gmat]
+        pieces = EXPORT_FORMATS[format](nodes, edges, hosts)
+        f = open(path + '.tmp', 'w')
+        self._export_chunk(f, pieces, path)
+
+
+    def _export_chunk(self, f, pieces, path):
+        try:
+            for i in range(EXPORT_CHUNK_SIZE):
+                try:
+                    f.write(pieces.next())
+                except StopIteration:
+                    f.close()
+                    os.rename(f.name, path)
+                    log.info('Topology exported to %s' % path)
+                    return
+        except (IOError, OSError), e:
+            # nobody would hear about it from callLater, clean up and tell
+            log.error('Could not export topology to %s (%s)' % (path, e))
+            f.close()
+            if os.path.exists(f.name):
+                os.remove(f.name)
+            return
+        # let the other events go through before writing more
+        core.callLater(self._export_chunk, f, pieces, path)
+
+def launch(shard = 0, shards = 1, listen = '127.0.0.1:7790', peers = ''):
+    """
+    Sharded mode, e.g. two processes on the same host:
+
+    discovery --shard=0 --shards=2 --listen=127.0.0.1:7790 --peers=127.0.0.1:7791
+    discovery --shard=1 --shards=2 --listen=127.0.0.1:7791 --peers=127.0.0.1:7790
+    """
+    peers = [parse_address(p) for p in peers.split(',') if p]
+    core.register('discovery', Discovery(int(shard), int(shards), parse_address(listen), peers))
     log.info('Discovery registered')
@@ -4,65 +4,195 @@ import re
 import datetime
 import argparse
 import subprocess
-import multiprocessing
-import threading
-import Queue
+import select
+import socket
+import struct
 from sets import Set
 from pcapy import *
-from scapy.all import *
+
+# max packets read from a bridge before looking at the others
+SNIFF_BATCH = 64
+# ip protocols we know how to get ports/seq from
+IPPROTO_ICMP = 1
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+def get_names(br_name):
+    """
+    dummy interface and mirror names used for bridge br_name
+    """
+    index = re.search('\d+$', br_name).group()
+    return "dummy%s" % index, "mirror%s" % index
+
+
+def arm_mirrors(bridges):
+    """
+    brings up the dummy interfaces and mirrors every bridge to its dummy
+    port. one 'ip' and one 'ovs-vsctl' (a single OVSDB transaction) for all
+    the bridges. returns True if no issues
+    """
+    dummies = [get_names(b)[0] for b in bridges]
+    ip = subprocess.Popen(['ip','-batch','-'], stdin = subprocess.PIPE)
+    ip.communicate(''.join(["link set up %s\n" % d for d in dummies]))
+    if ip.returncode:
+        print "error: could not bring up dummy interfaces %s" % dummies
+        return False
+    cmd = ['ovs-vsctl']
+    for i, b in enumerate(bridges):
+        (dummy_name, mirror_name) = get_names(b)
+        # pre-emptive cleaning of mirrors
+        cmd += ['--','clear','Bridge', b,'mirrors',\
+                '--','--may-exist','add-port', b, dummy_name,\
+                '--','--id=@p%s' % i,'get','port', dummy_name,\
+                '--','--id=@m%s' % i,'create','mirror','name=%s' % mirror_name,\
+                     'select_all=true','output_port=@p%s' % i,\
+                '--','add','bridge', b,'mirrors','@m%s' % i]
+    try:
+        subprocess.check_call(cmd)
+    except subprocess.CalledProcessError:
+        print "error: could not create mirrors for switches %s" % bridges
+        return False
+    return True
+
+
+def disarm_mirrors(bridges):
+    """
+    removes mirrors and dummy ports of all the bridges in one OVSDB
+    transaction
+    """
+    cmd = ['ovs-vsctl']
+    for b in bridges:
+        cmd += ['--','clear','Bridge', b,'mirrors',\
+                '--','--if-exists','del-port', b, get_names(b)[0]]
+    subprocess.call(cmd)
+
 
 class OVSSniff():
 
-    def __init__(self, br_name, filter):
-        # create dummy interfaces
-        index = re.search('\d+$', br_name).group()
-        dummy_name = "dummy%s" % index
-        try:
-            subprocess.check_call(['ip','link','set','up', dummy_name])
-        except:
-            print "error: could not create dummy interface %s" % dummy_name
-            return None
-        # create mirrors
-        mirror_name = "mirror%s" % index
-        try:
-            subprocess.check_call(['ovs-vsctl','--','--may-exist','add-port', br_name, dummy_name])
-            subprocess.check_call(['ovs-vsctl','--','--id=@p','get','port', dummy_name,\
-                                               '--','--id=@m','create','mirror','name=%s' % mirror_name,\
-                                               '--','add','bridge', br_name,'mirrors','@m',\
-                                               '--','set','mirror', mirror_name,'output_port=@p'])
-            subprocess.check_call(['ovs-vsctl','set','mirror', mirror_name, 'select_all=1'])
-        except:
-            print "error: could not create mirror for switch %s" % br_name
-            return None
+    def __init__(self, br_name, filter, dump_dir = None):
+        # no capture handle until everything is in place
+        self.reader = None
+        self.dumper = None
+        (dummy_name, mirror_name) = get_names(br_name)
         # sniffing object's state
         self.br_name = br_name
         self.dummy = dummy_name
         self.mirror = mirror_name
-        self.reader = open_live(dummy_name, 255, 1, 100)
-        self.reader.setfilter(filter)
+        try:
+            reader = open_live(dummy_name, 255, 1, 100)
+            reader.setfilter(filter)
+        except PcapError, e:
+            print "error: could not sniff %s (%s)" % (dummy_name, e)
+            return None
+        # we are told by epoll when there is something to read
+        reader.setnonblock(1)
+        # keep the capture for offline replay
+        if dump_dir:
+            path = os.path.join(dump_dir, '%s.pcap' % br_name)
+            try:
+                self.dumper = reader.dump_open(path)
+            except PcapError, e:
+                print "error: could not write %s (%s)" % (path, e)
+                return None
+        self.reader = reader
+
+    def fileno(self):
+        return self.reader.getfd()
+
+    def drain(self, callback):
+        """
+        reads up to SNIFF_BATCH packets, calls callback(br_name, hdr, data)
+        for each of them
+        """
+        return self.reader.dispatch(SNIFF_BATCH, self._got_packet(callback))
+
+    def _got_packet(self, callback):
+        def got_packet(hdr, data):
+            if self.dumper:
+                self.dumper.dump(hdr, data)
+            callback(self.br_name, hdr, data)
+        return got_packet
+
+
+def decode_flow(data):
+    """
+    gets the flow key (src, dst, proto, sport, dport) out of an ethernet
+    frame. for ICMP sport/dport are the echo id/seq. returns None if not IP
+    """
+    if len(data) < 14:
+        return None
+    offset = 12
+    # skip vlan tags
+    (type,) = struct.unpack('!H', data[offset:offset + 2])
+    while type == 0x8100 and len(data) >= offset + 6:
+        offset += 4
+        (type,) = struct.unpack('!H', data[offset:offset + 2])
+    offset += 2
+    if type != 0x0800 or len(data) < offset + 20:
+        return None
+    ihl = (ord(data[offset]) & 0x0f) * 4
+    proto = ord(data[offset + 9])
+    src = socket.inet_ntoa(data[offset + 12:offset + 16])
+    dst = socket.inet_ntoa(data[offset + 16:offset + 20])
+    l4 = data[offset + ihl:offset + ihl + 8]
+    sport = dport = None
+    if proto in (IPPROTO_TCP, IPPROTO_UDP) and len(l4) >= 4:
+        (sport, dport) = struct.unpack('!HH', l4[:4])
+    elif proto == IPPROTO_ICMP and len(l4) >= 8:
+        (sport, dport) = struct.unpack('!HH', l4[4:8])
+    return (src, dst, proto, sport, dport)
+
 
-    def _sniffing_callback(self, hdr, data):
-        self.packet_header = hdr
-        self.packet = data
+def do_sniffing(sniffers, hits):
+    """
+    single threaded capture loop over all the sniffers. hits gets, per
+    bridge, the set of flows seen by it. runs until interrupted
+    """
+    def got_packet(br_name, hdr, data):
+        flow = decode_flow(data)
+        if not flow:
+            return
+        (sec, usec) = hdr.getts()
+        ts = datetime.datetime.fromtimestamp(sec + usec / 1000000.0)
+        print "%s @ %s %s -> %s (%s)" % (ts, br_name, flow[0], flow[1], flow[4])
+        hits.setdefault(br_name, Set()).add(flow)
 
-    def get_packet(self):
-        if not self.reader.dispatch(1, self._sniffing_callback):
-            return None, None, None, None
-        return datetime.datetime.now(), self.br_name, self.packet_header, self.packet
+    ep = select.epoll()
+    by_fd = {}
+    for s in sniffers:
+        by_fd[s.fileno()] = s
+        ep.register(s.fileno(), select.EPOLLIN)
+    try:
+        while True:
+            for fd, event in ep.poll():
+                by_fd[fd].drain(got_packet)
+    finally:
+        ep.close()
 
 
-def do_sniffing(br_name, filter, running, q):
-    # create sniffing object from OVS switch
-    s = OVSSniff(br_name, filter)
-    if not s: 
-        print "could not create sniffing object for switch %s" % br_name
-        return
-    while running.is_set():
-        (time, b, hdr, data) = s.get_packet()
-        pkt = Ether(data)
-        if IP in pkt:
-            print "%s @ %s %s -> %s (%s)" % (time, b, pkt[IP].src, pkt[IP].dst, pkt[ICMP].seq)
-            q.put(b)
+def replay(paths):
+    """
+    reads per bridge captures (<bridge>.pcap, as written by -w) and returns
+    a dict flow -> list of bridges, in the order the flow went through them
+    """
+    # flow -> {bridge: first time seen}
+    first_seen = {}
+    def got_packet(br_name, hdr, data):
+        flow = decode_flow(data)
+        if not flow:
+            return
+        ts = hdr.getts()
+        seen = first_seen.setdefault(flow, {})
+        if not br_name in seen or ts < seen[br_name]:
+            seen[br_name] = ts
+    for path in paths:
+        br_name = os.path.splitext(os.path.basename(path))[0]
+        reader = open_offline(path)
+        reader.dispatch(-1, lambda hdr, data: got_packet(br_name, hdr, data))
+    paths = {}
+    for flow, seen in first_seen.items():
+        paths[flow] = sorted(seen.keys(), key = seen.get)
+    return paths
 
 
 
@@ -76,10 +206,6 @@ def list_bridges():
 
 
 def main():
-    # running as root?
-    if not os.getuid() == 0:
-        sys.exit("not running as root. exiting...")
-
     # process command-line
     parser = argparse.ArgumentParser()
     parser.add_argument('-b','--bridge', dest = 'bridges', nargs = '+', default = 'all', \
@@ -88,8 +214,24 @@ def main():
                          help = 'pcap style filter. Defaults to "ip".')
     parser.add_argument('--list-br', dest = 'list_bridges', action = 'store_true', \
                          help = 'Get a list of OVS switches running.')
+    parser.add_argument('-w','--write', dest = 'dump_dir', \
+                         help = 'Save each bridge capture to DUMP_DIR/<bridge>.pcap.')
+    parser.add_argument('-r','--replay', dest = 'replay', nargs = '+', \
+                         help = 'Offline mode. Get the switch path of every flow from captures saved with -w.')
     args = parser.parse_args()
 
+    # offline mode, no need for OVS nor root
+    if args.replay:
+        paths = replay(args.replay)
+        for flow in sorted(paths.keys()):
+            (src, dst, proto, sport, dport) = flow
+            print "%s:%s -> %s:%s (%s): %s" % (src, sport, dst, dport, proto, ' -> '.join(paths[flow]))
+        sys.exit()
+
+    # running as root?
+    if not os.getuid() == 0:
+        sys.exit("not running as root. exiting...")
+
     # print list of running OVS bridges and exit
     if args.list_bridges:
         list_bridges()
@@ -128,37 +270,45 @@ def main():
 
     # at this point we have a valid list of OVS swicthes
 
-    # pre-emptive cleaning of mirrors
-    print "cleaning previous mirrors..."
-    for b in args.bridges:
-        subprocess.call(['ovs-vsctl','clear','Bridge', b,'mirrors'])
-
-    print "about to create sniffers for ", args.bridges
-    jobs = []
-    q = Queue.Queue()
-    running = threading.Event()
-    running.set()
-    for b in args.bridges:
-        p = threading.Thread(target = do_sniffing, args = (b, args.filter, running, q))
-        jobs.append(p)
-        p.start()
+    # where captures are saved has to be fine before touching OVS
+    if args.dump_dir and not (os.path.isdir(args.dump_dir) and os.access(args.dump_dir, os.W_OK)):
+        print "%s is not a writable directory. exiting..." % args.dump_dir
+        sys.exit()
+
+    print "cleaning previous mirrors and creating new ones..."
     try:
-        while True:
+        if not arm_mirrors(args.bridges):
+            sys.exit()
+
+        print "about to create sniffers for ", args.bridges
+        sniffers = []
+        for b in args.bridges:
+            # create sniffing object from OVS switch
+            s = OVSSniff(b, args.filter, args.dump_dir)
+            if not s.reader:
+                print "could not create sniffing object for switch %s" % b
+                continue
+            sniffers.append(s)
+        if not sniffers:
+            # nothing to poll, the finally below still cleans the mirrors
+            print "could not create any sniffing object. exiting..."
+            sys.exit()
+        hits = {}
+        try:
+            do_sniffing(sniffers, hits)
+        except KeyboardInterrupt:
             pass
-    except:
         print "switch SET for the flow %s" % args.filter
-        trace = Set()
-        while not q.empty():
-            trace.add(q.get())
+        trace = Set(hits.keys())
         print trace
+        # dumpers flush and close their files when released
+        for s in sniffers:
+            s.dumper = None
+    finally:
+        # whatever happened, do not leave mirrors and dummy ports behind
         print "cleaning mirrors..."
-        for b in args.bridges:
-            subprocess.call(['ovs-vsctl','clear','Bridge', b,'mirrors'])
-        print "trying to shutdown sniffers...."
-        running.clear()
-        for j in jobs:
-            j.join()
-        print "sniffers are shutdown...."
+        disarm_mirrors(args.bridges)
+    print "sniffers are shutdown...."
 
 if __name__ == "__main__":
     main()
@@ -2,35 +2,95 @@
 from pox.core import core
 from pox.lib.revent import *
 from pox.lib.addresses import IPAddr
+from pox.lib.recoco import Timer
 import pox.openflow.libopenflow_01 as of
 # from me 
 from util import *
 # from third parties
 import networkx as nx
-from scapy.all import Ether, IP, ICMP, TCP, UDP
+# from python
+import bisect
+import struct
+import time
 
 
 log = core.getLogger()
 
+# how long shoud flows be "active" at the switch?
+ROUTING_FLOW_IDLE_TIMEOUT = 15
+# start evicting routes when a table is this full
+FLOW_TABLE_HIGH_WATER = 0.9
+# how often (seconds) flow counters are polled to track route usage
+FLOW_STATS_INTERVAL = 5
+
+class FlowTable(object):
+    """
+    Book-keeping of the routing entries installed in one switch. Routes are
+    kept per destination host and installed aggregated into prefixes
+    """
+
+    def __init__(self, dpid, size):
+        self.dpid = dpid
+        # max number of routing entries this switch can hold
+        self.size = size
+        # destination ip (unsigned) -> output port
+        self.routes = {}
+        # installed entries (net, prefixlen) -> {port, packets, last_used}
+        self.entries = {}
+
+    def routes_in(self, net, plen):
+        """
+        returns the destinations routed in this switch covered by net/plen
+        """
+        mask = (0xffffffff << (32 - plen)) & 0xffffffff
+        return [ip for ip in self.routes.keys() if ip & mask == net]
+
+    def covers(self, ip):
+        """
+        True if an installed entry of this switch matches ip
+        """
+        for (net, plen) in self.entries.keys():
+            mask = (0xffffffff << (32 - plen)) & 0xffffffff
+            if ip & mask == net:
+                return True
+        return False
+
+
 class Routing( EventMixin ):
 
     # XXX listen to portstatus and modify routing of port status changes?
 
-    def __init__(self):
+    def __init__(self, flow_table_size = 1000, metric = 'hops'):
+        # dpid -> FlowTable
+        self.flow_tables = {}
+        # max number of routing entries per switch
+        self.flow_table_size = flow_table_size
+        # 'hops' for shortest paths, 'latency' for minimum latency paths
+        self.metric = metric
+        # sorted ips (unsigned) of all known hosts, prefixes must not
+        # swallow the ones a switch has no route for
+        self.known = sorted(set([IPAddr(x['ip']).toUnsigned() for x in core.discovery.gmat]))
         # listen to all events from core
         core.openflow.addListeners(self)
+        # new hosts may be swallowed by already installed prefixes
+        core.discovery.addListeners(self)
+        # poll flow counters to know which routes are in use
+        Timer(FLOW_STATS_INTERVAL, self.request_flow_stats, recurring = True)
 
     def _handle_PacketIn(self, event):
 
-        # scapy-fy packet
-        pkt = Ether(event.data)
-
+        # switch belongs to another shard
+        if not core.discovery.owns(event.dpid):
+            return
 
-        # if packet not IP then nothing to see here, move along
-        if not pkt[Ether].type == 0x0800:
+        # if packet not IP then nothing to see here, move along. checked
+        # straight from the frame, no need to parse LLDPs and ARPs
+        if not struct.unpack('!H', event.data[12:14])[0] == 0x0800:
             return
+
         # we do have an IP ethertype, but do we really have an ip packet?
-        if not IP in pkt:
+        pkt = event.parsed.find('ipv4')
+        if not pkt:
             return
 
         # TODO security check for policy component and validate if packet is
@@ -38,8 +98,8 @@ class Routing( EventMixin ):
         # only L3 and above
 
         # "documentation" variables
-        src_ip = pkt[IP].src
-        dst_ip = pkt[IP].dst
+        src_ip = str(pkt.srcip)
+        dst_ip = str(pkt.dstip)
         log.debug('ROUTING: Got ip packet: %s -> %s' % (src_ip, dst_ip))
 
         # where is src located? 
@@ -84,7 +144,7 @@ class Routing( EventMixin ):
 
         # before expending any cycles, do we have a path from src dpid to dst
         # dpid?
-        if not nx.has_path(core.discovery.topo, src_dpid, dst_dpid):
+        if not core.discovery.connectivity.connected(src_dpid, dst_dpid):
             return None
 
         # this is a very "lazy" algorithm implementing shortest_path, other
@@ -96,6 +156,9 @@ class Routing( EventMixin ):
         # XXX test, manual path definition
         if src_dpid == 5 and dst_dpid == 2:
             p = [5,4,1,3,2]
+        elif self.metric == 'latency':
+            # links not measured yet weight 1 second
+            p = nx.shortest_path(core.discovery.topo, src_dpid, dst_dpid, weight = 'latency')
         else:
             p = nx.shortest_path(core.discovery.topo, src_dpid, dst_dpid)
 
@@ -117,101 +180,220 @@ class Routing( EventMixin ):
 
     def install_flows(self, pkt, path):
         """
-        Install flows on the switch according to path. Expects path to be a
-        list of {n1,p1,n2,p2}. Returns True if no issues, otherwise False
+        Install flows on the switch according to path. Expects pkt to be the
+        ipv4 packet as parsed by POX and path to be a list of {n1,p1,n2,p2}.
+        Returns True if no issues, otherwise False
         """
         # XXX have to fix situation where path may get broken because of links going down
 
-        # XXX do we have to book-keep which flows were installed in which dpid? 
-
-        if not IP in pkt:
+        if not pkt:
             log.error('ROUTING: Installing flow, but no IP packet to match in egress witch')
             return False
 
-        # how long shoud flows be "active" at the switch?
-        ROUTING_FLOW_IDLE_TIMEOUT = 15
-
         # "documentation/convenience" variable
-        src_ip = pkt[IP].src
-        dst_ip = pkt[IP].dst
+        src_ip = str(pkt.srcip)
+        dst_ip = str(pkt.dstip)
 
+        # list of routes (dpid, ip, port) to install
+        routes = []
         # ------> install flows (direction from n1 to n2)
         for n in path:
-            # get connection object from dpid (source node)
-            conn = core.openflow.getConnection(n['n1'])
-            if not conn:
-                log.error('ROUTING: Could not get connection from switch %s' % n['n1'])
-                return False
-            # create flow_mod message
-            msg = of.ofp_flow_mod()
-            msg.idle_timeout = ROUTING_FLOW_IDLE_TIMEOUT
-            msg.match.dl_type = 0x0800
-            msg.match.nw_dst = dst_ip
-            msg.actions.append(of.ofp_action_output(port=n['p1']))
-            # XXX does conn.send returns an error if failed?
-            # XXX time for a barrier_request?
-            conn.send(msg)
+            routes.append((n['n1'], dst_ip, n['p1']))
 
         # src -> dst egress port from egress node comes from gmat
         (egress_dpid, egress_port) = find_dpid_port_by_ip(dst_ip)
         if not egress_dpid or not egress_port:
             log.error('ROUTING: Could not locate egress switch/port')
             return False
-        conn = core.openflow.getConnection(egress_dpid)
-        if not conn:
-            log.error('ROUTING: Could not get connection from egress switch %s' % egress_dpid)
-            return False
-        msg = of.ofp_flow_mod()
-        msg.idle_timeout = ROUTING_FLOW_IDLE_TIMEOUT
-        msg.match.dl_type = 0x0800
-        msg.match.nw_dst = dst_ip
-        msg.actions.append(of.ofp_action_output(port=egress_port))
-        # XXX does conn.send returns an error if failed?
-        # XXX time for a barrier_request?
-        conn.send(msg)
+        routes.append((egress_dpid, dst_ip, egress_port))
 
         # <------ install flow (direction from n2 to n1)
         for n in path:
-            conn = core.openflow.getConnection(n['n2'])
-            if not conn:
-                log.error('ROUTING: Could not get connection from switch %s' % n['n2'])
-                return False
-            # create flow_mod message
-            msg = of.ofp_flow_mod()
-            msg.idle_timeout = ROUTING_FLOW_IDLE_TIMEOUT
-            msg.match.dl_type = 0x0800
-            msg.match.nw_dst = src_ip
-            msg.actions.append(of.ofp_action_output(port=n['p2']))
-            # XXX does conn.send returns an error if failed?
-            # XXX time for a barrier_request?
-            conn.send(msg)
+            routes.append((n['n2'], src_ip, n['p2']))
 
         # dst -> src egress port from egress node comes from gmat
         (egress_dpid, egress_port) = find_dpid_port_by_ip(src_ip)
         if not egress_dpid or not egress_port:
             log.error('ROUTING: Could not locate egress switch/port')
             return False
-        conn = core.openflow.getConnection(egress_dpid)
+        routes.append((egress_dpid, src_ip, egress_port))
+
+        # switches of other shards get their flows from their own shard
+        # when the traffic gets to them
+        routes = [r for r in routes if core.discovery.owns(r[0])]
+
+        # do not leave a half installed path behind
+        for (dpid, ip, port) in routes:
+            if not core.openflow.getConnection(dpid):
+                log.error('ROUTING: Could not get connection from switch %s' % dpid)
+                return False
+        for (dpid, ip, port) in routes:
+            if not self.add_route(dpid, ip, port):
+                return False
+
+        # so far so good
+        return True
+
+
+    def add_route(self, dpid, ip, port):
+        """
+        Books-keeps that traffic to 'ip' leaves 'dpid' through 'port' and
+        updates the flows installed in dpid. Returns True if no issues,
+        otherwise False
+        """
+        # get connection object from dpid
+        conn = core.openflow.getConnection(dpid)
         if not conn:
-            log.error('ROUTING: Could not get connection from egress switch %s' % egress_dpid)
+            log.error('ROUTING: Could not get connection from switch %s' % dpid)
             return False
-        msg = of.ofp_flow_mod()
-        msg.idle_timeout = ROUTING_FLOW_IDLE_TIMEOUT
-        msg.match.dl_type = 0x0800
-        msg.match.nw_dst = src_ip
-        msg.actions.append(of.ofp_action_output(port=egress_port))
-        # XXX does conn.send returns an error if failed?
-        # XXX time for a barrier_request?
-        conn.send(msg)
+        if not dpid in self.flow_tables:
+            self.flow_tables[dpid] = FlowTable(dpid, self.flow_table_size)
+        table = self.flow_tables[dpid]
+        table.routes[IPAddr(ip).toUnsigned()] = port
+        return self.sync_flow_table(dpid)
 
-        # so far so good
+
+    def sync_flow_table(self, dpid):
+        """
+        Aggregates the routes of dpid into prefixes, evicts the least
+        recently used entries if the table is about to be full and sends to
+        the switch only the entries that changed. Returns True if no issues,
+        otherwise False
+        """
+        table = self.flow_tables.get(dpid)
+        conn = core.openflow.getConnection(dpid)
+        if not table or not conn:
+            return False
+        wanted = aggregate_routes(table.routes, self.known)
+        # entries already installed keep their last use, new ones are fresh
+        now = time.time()
+        last_used = {}
+        for (net, plen, port) in wanted:
+            entry = table.entries.get((net, plen))
+            last_used[(net, plen)] = entry and entry['last_used'] or now
+        # table is getting full, evict the lru entries (and the routes they
+        # aggregate) to get back to the high water mark. prefixes are
+        # disjoint, so the entries left stay valid as they are
+        high_water = int(table.size * FLOW_TABLE_HIGH_WATER)
+        if len(wanted) > high_water:
+            wanted.sort(key = lambda w: last_used[(w[0], w[1])])
+            evicted = len(wanted) - high_water
+            for (net, plen, port) in wanted[:evicted]:
+                for ip in table.routes_in(net, plen):
+                    del table.routes[ip]
+                log.debug('ROUTING: Switch %s table full, evicting %s/%s' % (dpid, IPAddr(net), plen))
+            wanted = wanted[evicted:]
+        wanted = dict([((net, plen), port) for (net, plen, port) in wanted])
+
+        # remove entries not wanted anymore...
+        for (net, plen) in table.entries.keys():
+            if (net, plen) in wanted:
+                continue
+            msg = of.ofp_flow_mod(command = of.OFPFC_DELETE_STRICT)
+            msg.match = self.route_match(net, plen)
+            conn.send(msg)
+            del table.entries[(net, plen)]
+        # ...and add new ones or the ones with a different output port
+        for (net, plen), port in wanted.items():
+            entry = table.entries.get((net, plen))
+            if entry and entry['port'] == port:
+                continue
+            msg = of.ofp_flow_mod()
+            msg.idle_timeout = ROUTING_FLOW_IDLE_TIMEOUT
+            msg.flags = of.OFPFF_SEND_FLOW_REM
+            msg.match = self.route_match(net, plen)
+            msg.actions.append(of.ofp_action_output(port = port))
+            # XXX does conn.send returns an error if failed?
+            # XXX time for a barrier_request?
+            conn.send(msg)
+            table.entries[(net, plen)] = dict(port = port, packets = 0, \
+                                              last_used = last_used[(net, plen)])
         return True
 
 
-def launch():
+    def route_match(self, net, plen):
+        """
+        Returns the ofp_match for the ip prefix net/plen
+        """
+        return of.ofp_match(dl_type = 0x0800, nw_dst = '%s/%s' % (IPAddr(net), plen))
+
+
+    def request_flow_stats(self):
+        """
+        Asks all switches for the counters of their IP flows. Counters are
+        used to find out which entries are least recently used
+        """
+        for conn in core.openflow.connections:
+            if not core.discovery.owns(conn.dpid):
+                continue
+            body = of.ofp_flow_stats_request(match = of.ofp_match(dl_type = 0x0800))
+            conn.send(of.ofp_stats_request(body = body))
+
+
+    def _handle_FlowStatsReceived(self, event):
+        table = self.flow_tables.get(event.connection.dpid)
+        if not table:
+            return
+        for stat in event.stats:
+            (net, plen) = stat.match.get_nw_dst()
+            if net is None:
+                continue
+            entry = table.entries.get((net.toUnsigned(), plen))
+            # has the entry seen traffic since last time?
+            if not entry or stat.packet_count <= entry['packets']:
+                continue
+            entry['packets'] = stat.packet_count
+            entry['last_used'] = time.time()
+
+
+    def _handle_FlowRemoved(self, event):
+        # entries deleted by sync_flow_table are already forgotten
+        if event.ofp.reason == of.OFPRR_DELETE:
+            return
+        table = self.flow_tables.get(event.dpid)
+        (net, plen) = event.ofp.match.get_nw_dst()
+        if not table or net is None:
+            return
+        # entry already replaced by a re-aggregation, its routes now belong
+        # to entries still installed
+        if not (net.toUnsigned(), plen) in table.entries:
+            return
+        # entry expired, forget about it and the routes it aggregates
+        del table.entries[(net.toUnsigned(), plen)]
+        for ip in table.routes_in(net.toUnsigned(), plen):
+            del table.routes[ip]
+        log.debug('ROUTING: Switch %s flow to %s/%s expired' % (event.dpid, net, plen))
+
+
+    def _handle_HostAdded(self, event):
+        ip = IPAddr(event.host['ip']).toUnsigned()
+        i = bisect.bisect_left(self.known, ip)
+        if i < len(self.known) and self.known[i] == ip:
+            return
+        self.known.insert(i, ip)
+        # re-aggregate the switches whose prefixes now cover a host they
+        # have no route for, otherwise its traffic is sent the wrong way
+        for dpid, table in self.flow_tables.items():
+            if not ip in table.routes and table.covers(ip):
+                log.debug('ROUTING: Switch %s prefixes cover new host %s' % (dpid, IPAddr(ip)))
+                self.sync_flow_table(dpid)
+
+
+    def _handle_ConnectionUp(self, event):
+        # discovery wipes all flows of a (re)connecting switch
+        if event.dpid in self.flow_tables:
+            del self.flow_tables[event.dpid]
+
+
+    def _handle_ConnectionDown(self, event):
+        if event.dpid in self.flow_tables:
+            del self.flow_tables[event.dpid]
+
+
+def launch(flow_table_size = 1000, metric = 'hops'):
     # discovery and arp_response are necessary components for routing
     if core.hasComponent('discovery') and core.hasComponent('arp_response'):
-        component = Routing()
+        component = Routing(int(flow_table_size), metric)
         core.register('routing', component)
         log.debug('ROUTING: Routing registered')
     else:
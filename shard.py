@@ -0,0 +1,105 @@
+"""
+Copyright (c) 2013, Javier Liendo All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+Redistributions of source code must retain the above copyright notice, this list
+of conditions and the following disclaimer.
+
+Redistributions in binary form must reproduce the above copyright notice, this
+list of conditions and the following disclaimer in the documentation and/or
+other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR
+TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF
+THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""
+Topology deltas exchange between discovery shards. Each shard is a POX
+process running discovery for the switches it owns (dpid % shards == shard).
+Shards tell each other about the links, hosts and switches they learn/lose
+with small json datagrams over udp, so it works for several processes on
+the same host or on a LAN.
+
+Message format: {'shard': <sender>, 'type': <type>, ...}
+
+- 'links': 'links' is a list of [n1, p1, n2, p2]. Port p1 of n1 links to
+  port p2 of n2
+- 'link_down': 'links' is a list of [n1, n2]
+- 'hosts': 'hosts' is a list of gmat entries (dpid, port, mac, ip)
+- 'switch_down': 'dpid' is the switch that went down
+"""
+from pox.core import core
+import json
+import socket
+import threading
+
+log = core.getLogger()
+
+# max number of links/hosts per datagram
+SHARD_CHUNK_SIZE = 200
+
+
+def parse_address(address):
+    """
+    'host:port' -> (host, port)
+    """
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+class ShardChannel(object):
+
+    def __init__(self, shard, listen, peers, handler):
+        # our shard number, used to tag messages
+        self.shard = shard
+        # list of (host, port) of the other shards
+        self.peers = peers
+        # handler(msg) is called from the POX thread for every message
+        self.handler = handler
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(listen)
+        t = threading.Thread(target = self._receive)
+        t.daemon = True
+        t.start()
+        log.info('SHARD: shard %s listening at %s:%s, peers %s' % ((shard,) + listen + (peers,)))
+
+    def publish(self, type, key = None, items = None, **kw):
+        """
+        sends a message to all peers. if items is given, it is sent under
+        'key' split in as many datagrams as needed
+        """
+        if items is None:
+            self._send(dict(kw, shard = self.shard, type = type))
+            return
+        for i in range(0, len(items), SHARD_CHUNK_SIZE):
+            kw[key] = items[i:i + SHARD_CHUNK_SIZE]
+            self._send(dict(kw, shard = self.shard, type = type))
+
+    def _send(self, msg):
+        data = json.dumps(msg)
+        for peer in self.peers:
+            try:
+                self.sock.sendto(data, peer)
+            except socket.error, e:
+                log.error('SHARD: could not send to %s:%s (%s)' % (peer + (e,)))
+
+    def _receive(self):
+        while True:
+            data, addr = self.sock.recvfrom(65535)
+            try:
+                msg = json.loads(data)
+            except ValueError:
+                log.error('SHARD: bad message from %s:%s' % addr)
+                continue
+            # topology belongs to the POX thread
+            core.callLater(self.handler, msg)
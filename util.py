@@ -31,9 +31,25 @@ p3 of n1 links to n4
 
 """
 from pox.core import core
+from xml.sax.saxutils import quoteattr
+import bisect
+import json
+import struct
 
 log = core.getLogger()
 
+# LLDP destination address '01:80:c2:00:00:0e'
+LLDP_DST = '\x01\x80\xc2\x00\x00\x0e'
+# LLDP TLV types
+LLDP_END_TLV_TYPE = 0
+LLDP_CHASSIS_ID_TLV_TYPE = 1
+LLDP_PORT_ID_TLV_TYPE = 2
+LLDP_TTL_TLV_TYPE = 3
+LLDP_ORG_TLV_TYPE = 127
+# organizationally specific LLDP TLV carrying the controller send timestamp
+LLDP_TIMESTAMP_OUI = '\x00\x00\xca'
+LLDP_TIMESTAMP_SUBTYPE = 1
+
 def get_linking_ports(g, n1, n2):
     """
     returns the ports linking two nodes in g
@@ -134,3 +150,345 @@ def find_ip_by_dpid_port(dpid, port):
         return p.pop()
 
 
+
+
+def topology_json(nodes, edges, hosts):
+    """
+    yields, piece by piece, the json document of a topology snapshot.
+    nodes is a list of (n, link_to), edges a list of (n1, n2, data) and
+    hosts a list of gmat entries
+    """
+    yield '{"switches": ['
+    for i, (n, link_to) in enumerate(nodes):
+        yield (i and ',\n' or '\n') + json.dumps(dict(dpid = n, link_to = link_to))
+    yield '],\n"links": ['
+    for i, (n1, n2, d) in enumerate(edges):
+        yield (i and ',\n' or '\n') + json.dumps(dict(d, n1 = n1, n2 = n2))
+    yield '],\n"hosts": ['
+    for i, h in enumerate(hosts):
+        yield (i and ',\n' or '\n') + json.dumps(h)
+    yield ']}\n'
+
+
+def topology_graphml(nodes, edges, hosts):
+    """
+    yields, piece by piece, the graphml document of a topology snapshot
+    (same arguments as topology_json). switches are nodes 's<dpid>' and
+    hosts 'h<mac>' (ips comma separated), linked to every switch port the
+    mac was seen at
+    """
+    yield '<?xml version="1.0" encoding="utf-8"?>\n' \
+          '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n' \
+          '<key id="type" for="node" attr.name="type" attr.type="string"/>\n' \
+          '<key id="ip" for="node" attr.name="ip" attr.type="string"/>\n' \
+          '<key id="port" for="edge" attr.name="port" attr.type="int"/>\n' \
+          '<key id="latency" for="edge" attr.name="latency" attr.type="double"/>\n' \
+          '<graph edgedefault="undirected">\n'
+    switches = set()
+    for n, link_to in nodes:
+        switches.add(n)
+        yield '<node id="s%s"><data key="type">switch</data></node>\n' % n
+    for n1, n2, d in edges:
+        latency = ''
+        if 'latency' in d:
+            latency = '<data key="latency">%r</data>' % d['latency']
+        yield '<edge source="s%s" target="s%s">%s</edge>\n' % (n1, n2, latency)
+    # gmat has an entry per (dpid, port, mac, ip), but node ids must be
+    # unique: one node per mac with all its ips, one edge per attachment
+    macs = []
+    ips = {}
+    attached = {}
+    for h in hosts:
+        if not h['mac'] in ips:
+            macs.append(h['mac'])
+            ips[h['mac']] = []
+            attached[h['mac']] = []
+        if not h['ip'] in ips[h['mac']]:
+            ips[h['mac']].append(h['ip'])
+        if not (h['dpid'], h['port']) in attached[h['mac']]:
+            attached[h['mac']].append((h['dpid'], h['port']))
+        # host seen on a switch that is not (or no longer) in the topology,
+        # its edge would be dangling otherwise
+        if not h['dpid'] in switches:
+            switches.add(h['dpid'])
+            yield '<node id="s%s"><data key="type">switch</data></node>\n' % h['dpid']
+    for mac in macs:
+        id = quoteattr('h%s' % mac)
+        yield '<node id=%s><data key="type">host</data><data key="ip">%s</data></node>\n' % \
+              (id, ','.join(ips[mac]))
+        for dpid, port in attached[mac]:
+            yield '<edge source=%s target="s%s"><data key="port">%s</data></edge>\n' % \
+                  (id, dpid, port)
+    yield '</graph>\n</graphml>\n'
+
+
+def aggregate_routes(routes, known = []):
+    """
+    compresses a {ip: port} route dict (ips as unsigned ints) into the widest
+    non-overlapping prefixes whose destinations all share the same port.
+    known is a sorted list of ips, the ones without a route are never
+    covered by a returned prefix. returns a list of tuples (net, prefixlen,
+    port)
+    """
+    prefixes = []
+    pending = [sorted(routes.items())]
+    while pending:
+        entries = pending.pop()
+        if not entries:
+            continue
+        ports = set([p for (ip, p) in entries])
+        lo = entries[0][0]
+        hi = entries[-1][0]
+        # every destination goes out the same port, use their common prefix
+        # unless it swallows a known host with no route
+        if len(ports) == 1:
+            plen = 32 - (lo ^ hi).bit_length()
+            mask = (0xffffffff << (32 - plen)) & 0xffffffff
+            if lo == hi or not swallows(lo & mask, plen, routes, known):
+                prefixes.append((lo & mask, plen, ports.pop()))
+                continue
+        # otherwise split on the highest bit in which destinations differ
+        bit = 1 << ((lo ^ hi).bit_length() - 1)
+        pending.append([e for e in entries if not e[0] & bit])
+        pending.append([e for e in entries if e[0] & bit])
+    return prefixes
+
+
+def swallows(net, plen, routes, known):
+    """
+    True if net/plen covers an ip of the sorted list known with no route
+    """
+    end = net + (1 << (32 - plen))
+    i = bisect.bisect_left(known, net)
+    while i < len(known) and known[i] < end:
+        if not known[i] in routes:
+            return True
+        i += 1
+    return False
+
+
+def lldp_tlv(tlv_type, value):
+    """
+    returns the raw LLDP TLV of type tlv_type carrying value
+    """
+    return struct.pack('!H', (tlv_type << 9) | len(value)) + value
+
+
+def lldp_frame(src, chassis_id, port, ttl, ts):
+    """
+    returns the raw LLDP frame sent by discovery from port 'port' (mac
+    address 'src', raw bytes) of switch chassis_id. ts is the controller
+    send timestamp
+    """
+    # chassis and port ids are "locally assigned" (subtype 7)
+    tlvs = lldp_tlv(LLDP_CHASSIS_ID_TLV_TYPE, chr(7) + str(chassis_id)) + \
+           lldp_tlv(LLDP_PORT_ID_TLV_TYPE, chr(7) + str(port)) + \
+           lldp_tlv(LLDP_TTL_TLV_TYPE, struct.pack('!H', ttl)) + \
+           lldp_tlv(LLDP_ORG_TLV_TYPE, LLDP_TIMESTAMP_OUI + \
+                    struct.pack('!Bd', LLDP_TIMESTAMP_SUBTYPE, ts)) + \
+           lldp_tlv(LLDP_END_TLV_TYPE, '')
+    return LLDP_DST + src + struct.pack('!H', 0x88cc) + tlvs
+
+
+def parse_lldp(data):
+    """
+    walks the TLVs of the raw LLDP frame data. returns a dict (chassis_id,
+    port, ttl, timestamp) or None if it is not a well formed discovery LLDP.
+    timestamp is None if the frame does not carry one
+    """
+    lldp = dict(timestamp = None)
+    # skip ethernet header
+    offset = 14
+    while offset + 2 <= len(data):
+        (header,) = struct.unpack('!H', data[offset:offset + 2])
+        tlv_type = header >> 9
+        tlv_len = header & 0x1ff
+        value = data[offset + 2:offset + 2 + tlv_len]
+        offset += 2 + tlv_len
+        try:
+            if tlv_type == LLDP_END_TLV_TYPE:
+                if 'chassis_id' in lldp and 'port' in lldp and 'ttl' in lldp:
+                    return lldp
+                return None
+            elif tlv_type == LLDP_CHASSIS_ID_TLV_TYPE:
+                lldp['chassis_id'] = int(value[1:])
+            elif tlv_type == LLDP_PORT_ID_TLV_TYPE:
+                lldp['port'] = int(value[1:])
+            elif tlv_type == LLDP_TTL_TLV_TYPE:
+                (lldp['ttl'],) = struct.unpack('!H', value)
+            elif tlv_type == LLDP_ORG_TLV_TYPE and len(value) == 12 and \
+                value[:3] == LLDP_TIMESTAMP_OUI and \
+                ord(value[3]) == LLDP_TIMESTAMP_SUBTYPE:
+                (lldp['timestamp'],) = struct.unpack('!d', value[4:])
+        except (ValueError, struct.error):
+            return None
+    return None
+
+
+class Connectivity(object):
+    """
+    connected components index of a topology graph. every node carries the
+    id of its component and a spanning forest of the graph is kept along.
+    - adding a link between two components relabels the smaller one and
+      makes the link a tree link
+    - removing a non tree link changes nothing, O(1)
+    - removing a tree link searches, over the forest, the smaller of the two
+      halves it leaves and looks for a replacement link leaving it. only if
+      there is none (the link was a bridge) the half becomes a component
+    - removing a node re-searches its component (switches going down are
+      rare compared to link flaps)
+    connected() is O(1) for routing
+    """
+
+    def __init__(self, g):
+        self.g = g
+        # node -> component id
+        self.comp = {}
+        # component id -> set of nodes in it
+        self.members = {}
+        # spanning forest, node -> set of tree neighbours
+        self.tree = {}
+        self.next_id = 0
+        for n in g.nodes():
+            self.add_node(n)
+        for n1, n2 in g.edges():
+            self.add_edge(n1, n2)
+
+    def find(self, n):
+        """
+        returns the component id of n, None if n is unknown
+        """
+        return self.comp.get(n)
+
+    def connected(self, n1, n2):
+        """
+        True if there is a path between n1 and n2
+        """
+        c1 = self.comp.get(n1)
+        return c1 is not None and c1 == self.comp.get(n2)
+
+    def components(self):
+        """
+        returns a list with the set of nodes of every component
+        """
+        return [set(m) for m in self.members.values()]
+
+    def add_node(self, n):
+        if n in self.comp:
+            return False
+        self._new_component(set([n]))
+        self.tree[n] = set()
+        return True
+
+    def add_edge(self, n1, n2):
+        """
+        merges the components of n1 and n2. returns True if they were apart
+        """
+        self.add_node(n1)
+        self.add_node(n2)
+        c1 = self.comp[n1]
+        c2 = self.comp[n2]
+        if c1 == c2:
+            return False
+        self.tree[n1].add(n2)
+        self.tree[n2].add(n1)
+        # smaller component gets relabeled
+        if len(self.members[c1]) < len(self.members[c2]):
+            c1, c2 = c2, c1
+        nodes = self.members.pop(c2)
+        for n in nodes:
+            self.comp[n] = c1
+        self.members[c1] |= nodes
+        return True
+
+    def remove_edge(self, n1, n2):
+        """
+        to be called once the edge is gone from the graph. returns True if
+        the component got split
+        """
+        if not (n1 in self.comp and n2 in self.comp) or self.g.has_edge(n1, n2):
+            return False
+        # not a tree link, the forest still spans everything
+        if not n2 in self.tree[n1]:
+            return False
+        self.tree[n1].discard(n2)
+        self.tree[n2].discard(n1)
+        half = self._smaller_half(n1, n2)
+        # a link leaving the half replaces the removed one
+        for u in half:
+            for v in self.g.neighbors(u):
+                if not v in half:
+                    self.tree[u].add(v)
+                    self.tree[v].add(u)
+                    return False
+        # removed link was a bridge
+        self.members[self.comp[n1]] -= half
+        self._new_component(half)
+        return True
+
+    def remove_node(self, n):
+        """
+        to be called once the node is gone from the graph. returns True if
+        the component got split
+        """
+        c = self.comp.pop(n, None)
+        if c is None:
+            return False
+        for m in self.tree.pop(n):
+            self.tree[m].discard(n)
+        self.members[c].discard(n)
+        if not self.members[c]:
+            del self.members[c]
+            return False
+        return self._split(c) > 1
+
+    def _new_component(self, nodes):
+        c = self.next_id
+        self.next_id += 1
+        for n in nodes:
+            self.comp[n] = c
+        self.members[c] = nodes
+        return c
+
+    def _smaller_half(self, n1, n2):
+        """
+        n1 and n2 are in two different trees of the forest. searches both
+        trees a node at a time and returns the nodes of the first one done
+        """
+        seen = (set([n1]), set([n2]))
+        stacks = ([n1], [n2])
+        while True:
+            for i in (0, 1):
+                if not stacks[i]:
+                    return seen[i]
+                for m in self.tree[stacks[i].pop()]:
+                    if not m in seen[i]:
+                        seen[i].add(m)
+                        stacks[i].append(m)
+
+    def _split(self, c):
+        """
+        searches the graph within component c, splits it in the components
+        still connected and rebuilds their spanning trees. returns the
+        number of components
+        """
+        pending = self.members.pop(c)
+        for n in pending:
+            self.tree[n] = set()
+        count = 0
+        while pending:
+            start = pending.pop()
+            component = set([start])
+            stack = [start]
+            while stack:
+                n = stack.pop()
+                for m in self.g.neighbors(n):
+                    if m in pending:
+                        pending.discard(m)
+                        component.add(m)
+                        stack.append(m)
+                        self.tree[n].add(m)
+                        self.tree[m].add(n)
+            self._new_component(component)
+            count += 1
+        return count